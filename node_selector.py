@@ -8,19 +8,143 @@ import os
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util import connection as urllib3_connection
 import base64
+import binascii
 import re
 import argparse
 import random
+import socket
+import functools
+import bisect
+import operator
+import itertools
+import contextlib
 from datetime import datetime
 from urllib.parse import urlparse
+from pathlib import Path
 import concurrent.futures
 import threading
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 节点链接格式：按协议前缀查表，每行只需一次字典查找和一次预编译正则匹配
+_B64_BODY_RE = re.compile(r'([A-Za-z0-9+/=]+)')
+# base64订阅开头只会出现base64字符和换行
+_B64_SUB_HEAD_RE = re.compile(rb'[A-Za-z0-9+/=\s]+')
+_USER_HOST_RE = re.compile(r'([^@]+)@([^:]+):(\d+)')
+_NODE_PATTERNS = {
+    'ssr': _B64_BODY_RE,
+    'vmess': _B64_BODY_RE,
+    'trojan': _USER_HOST_RE,
+    'vless': _USER_HOST_RE,
+    'ss': _B64_BODY_RE,
+}
+# 订阅正文整体扫描：一次 finditer 取出所有以已知协议开头的行（忽略行首空白）
+_NODE_LINE_RE = re.compile(
+    r'^[ \t]*((?:' + '|'.join(_NODE_PATTERNS) + r')://[^\r\n]*)', re.MULTILINE
+)
+
+# 所有请求共用的请求头，创建会话时设置一次
+_DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Cache-Control': 'no-cache'
+}
+
+# HTTP连接超时(秒)：主机不可达时尽快失败，不必等满读取超时
+_CONNECT_TIMEOUT = 3
+
+# 使用指南末尾的固定内容
+_USAGE_GUIDE_FOOTER = """
+## ⚙️ 客户端配置建议
+1. NekoBox: 添加订阅 → 粘贴链接 → 自动更新
+2. FlClash: 订阅管理 → 添加 → 粘贴链接
+3. 建议开启自动选择最快节点
+4. 更新频率: 每6-12小时自动更新
+"""
+
+# 订阅文件中每个节点一段：注释行 + 节点链接 + 空行
+_SUBSCRIPTION_NODE_TEMPLATE = (
+    "# {index}. {country} | {latency}ms | {speed_mb:.1f}MB/s | {score}分\n"
+    "{node}\n"
+)
+
+# 使用指南中的节点列表行
+_USAGE_NODE_TEMPLATE = "{index}. {country} - {latency}ms - {speed_mb:.1f}MB/s - {score}分 ({type})\n"
+
+# 部署脚本模板，{encoded_nodes} 处填入base64编码的节点列表
+_CF_WORKER_TEMPLATE = """// Cloudflare Worker 部署订阅
+addEventListener('fetch', event => {{
+  event.respondWith(handleRequest(event.request))
+}})
+
+const nodes = `{encoded_nodes}`
+
+async function handleRequest(request) {{
+  const url = new URL(request.url)
+  
+  if (url.pathname === '/subscribe') {{
+    return new Response(nodes, {{
+      headers: {{
+        'Content-Type': 'text/plain;charset=UTF-8',
+        'Cache-Control': 'public, max-age=3600',
+        'Access-Control-Allow-Origin': '*'
+      }}
+    }})
+  }}
+  
+  return new Response('NekoBox Subscription Service', {{ status: 200 }})
+}}
+"""
+
+_VERCEL_FUNCTION_TEMPLATE = """// Vercel Function (api/subscribe.js)
+module.exports = (req, res) => {{
+  const nodes = `{encoded_nodes}`
+  
+  res.setHeader('Content-Type', 'text/plain;charset=UTF-8')
+  res.setHeader('Cache-Control', 'public, max-age=3600')
+  res.setHeader('Access-Control-Allow-Origin', '*')
+  res.send(nodes)
+}}
+"""
+
+# 评分分段表：延迟 <50ms 得100分，<100ms 得95分 ... ≥500ms 得40分
+_LATENCY_BOUNDS = (50, 100, 200, 300, 500)
+_LATENCY_SCORES = (100, 95, 85, 75, 60, 40)
+# 速度(KB/s)：0 得0分，≤100 得30分，≤500 得50分 ... >5000 得100分
+_SPEED_BOUNDS = (0, 100, 500, 1000, 2000, 5000)
+_SPEED_SCORES = (0, 30, 50, 70, 80, 90, 100)
+# 延迟达到此值(ms)的节点延迟分已是最低档，不再测速
+_SPEED_TEST_MAX_LATENCY = 500
+
+@functools.lru_cache(maxsize=4096)
+def _decode_endpoint(node_type, body):
+    """解码base64节点配置中的服务器地址和端口（订阅中常有重复配置，结果缓存复用）"""
+    decoded = base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)).decode('utf-8')
+    
+    if node_type == 'vmess':
+        config = orjson.loads(decoded) if orjson is not None else json.loads(decoded)
+        return str(config['add']), int(config['port'])
+    
+    if node_type == 'ssr':
+        # host:port:protocol:method:obfs:password_base64/?params
+        host, port = decoded.split('/?', 1)[0].rsplit(':', 5)[:2]
+        return host, int(port)
+    
+    # 旧版ss格式: ss://base64(method:password@host:port)
+    host, _, port = decoded.rpartition('@')[2].rpartition(':')
+    return host, int(port)
+
 class NodeSelector:
     def __init__(self, args):
         self.nodes_file = args.nodes_file
         self.output_dir = args.output_dir
+        self.output_path = Path(self.output_dir)
         
         # 命令行参数
         self.args = args
@@ -34,6 +158,7 @@ class NodeSelector:
         self.max_workers = args.workers
         self.test_count = args.test_count
         self.top_n = args.top_n
+        self.host_dedup = not args.no_host_dedup
         
         # 测试URL列表
         self.test_urls = [
@@ -52,7 +177,33 @@ class NodeSelector:
         ]
         
         self.results = []
-        self.lock = threading.Lock()
+        
+        # 地理位置只与运行环境的出口IP有关，每次运行查询一次即可
+        self.geo_info = None
+        
+        # 测试期间的DNS解析缓存：(主机, 端口) -> IP列表，见 _cached_dns
+        self._dns_cache = {}
+        
+        # 每个线程独立的HTTP会话：复用TCP/TLS连接，且线程之间不争用同一个连接池
+        # （requests.Session 本身不保证线程安全，因此不在线程间共享）
+        self._tls = threading.local()
+        self._sessions = []
+        
+        # 订阅获取和地理位置查询只在主线程进行，共用一个带重试的会话；
+        # 测速/延迟探测不重试，避免重试耗时计入测量结果
+        self.session = requests.Session()
+        # 限流(429)和服务暂不可用(503)时由 urllib3 退避重试，不在业务代码里固定 sleep
+        retries = Retry(
+            total=2,
+            backoff_factor=0.5,
+            status_forcelist=(429, 503),
+            respect_retry_after_header=False
+        )
+        adapter = HTTPAdapter(max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(_DEFAULT_HEADERS)
+        self._sessions.append(self.session)
         
     def get_subscription_urls(self):
         """从环境变量或命令行参数获取在线订阅地址"""
@@ -69,24 +220,76 @@ class NodeSelector:
         
         return []
     
+    def _resolve(self, host, port):
+        """解析HTTP请求的目标地址，结果缓存在本实例中"""
+        key = (host, port)
+        addrs = self._dns_cache.get(key)
+        if addrs is None:
+            addrs = [info[4][0] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+            self._dns_cache[key] = addrs
+        return addrs
+    
+    @contextlib.contextmanager
+    def _cached_dns(self):
+        """测试期间让 requests/urllib3 建连时复用DNS解析结果（所有节点都访问同一批测试地址）"""
+        # 只替换 urllib3 的建连函数，TCP预检等其他 socket 解析不经过缓存；退出时恢复
+        create_connection = urllib3_connection.create_connection
+        
+        def cached_create_connection(address, *args, **kwargs):
+            host, port = address
+            error = None
+            for ip in self._resolve(host, port):
+                try:
+                    return create_connection((ip, port), *args, **kwargs)
+                except OSError as e:
+                    error = e
+            raise error
+        
+        urllib3_connection.create_connection = cached_create_connection
+        try:
+            for test_url in self.test_urls:
+                try:
+                    self._resolve(urlparse(test_url['url']).hostname, 443)
+                except OSError:
+                    pass
+            yield
+        finally:
+            urllib3_connection.create_connection = create_connection
+            self._dns_cache.clear()
+    
+    def _session(self):
+        """获取当前线程的HTTP会话（首次调用时创建）"""
+        session = getattr(self._tls, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=8, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(_DEFAULT_HEADERS)
+            self._tls.session = session
+            self._sessions.append(session)
+        return session
+    
     def fetch_online_subscription(self, url):
         """获取在线订阅内容"""
         try:
             print(f"🔗 获取订阅: {url}")
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
             
-            response = requests.get(url, timeout=15, headers=headers)
+            response = self.session.get(url, timeout=(_CONNECT_TIMEOUT, 15))
             response.raise_for_status()
+            raw = response.content
             
-            try:
-                content = base64.b64decode(response.text).decode('utf-8')
-                print(f"✅ 订阅解码成功，长度: {len(content)} 字符")
-                return content
-            except:
-                print(f"✅ 订阅获取成功，长度: {len(response.text)} 字符")
-                return response.text
+            # 只嗅探开头部分，明文订阅不必整体尝试base64解码
+            if _B64_SUB_HEAD_RE.fullmatch(raw[:256]):
+                try:
+                    content = base64.b64decode(raw).decode('utf-8')
+                    print(f"✅ 订阅解码成功，长度: {len(content)} 字符")
+                    return content
+                except (binascii.Error, UnicodeDecodeError):
+                    pass
+            
+            print(f"✅ 订阅获取成功，长度: {len(response.text)} 字符")
+            return response.text
                 
         except Exception as e:
             print(f"❌ 获取订阅失败 [{url}]: {e}")
@@ -95,18 +298,12 @@ class NodeSelector:
     def parse_subscription_content(self, content):
         """解析订阅内容"""
         nodes = []
-        lines = content.split('\n')
         
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            if any(proto in line for proto in ['ss://', 'ssr://', 'vmess://', 'trojan://', 'vless://']):
-                node = self.parse_node_line(line)
-                if node:
-                    nodes.append(node)
-                    node['source'] = 'subscription'
+        for match in _NODE_LINE_RE.finditer(content):
+            node = self.parse_node_line(match.group(1))
+            if node:
+                nodes.append(node)
+                node['source'] = 'subscription'
         
         return nodes
     
@@ -116,8 +313,6 @@ class NodeSelector:
         
         # 1. 加载本地节点文件
         local_nodes = self.parse_nodes_file()
-        for node in local_nodes:
-            node['source'] = 'local'
         all_nodes.extend(local_nodes)
         print(f"📁 本地节点: {len(local_nodes)} 个")
         
@@ -130,22 +325,37 @@ class NodeSelector:
                     nodes = self.parse_subscription_content(content)
                     subscription_nodes.extend(nodes)
                     print(f"📥 从订阅获取节点: {len(nodes)} 个")
-                    time.sleep(1)
                     
             except Exception as e:
                 print(f"❌ 处理订阅失败 [{sub_url}]: {e}")
         
         all_nodes.extend(subscription_nodes)
         
-        # 去重
-        unique_nodes = []
-        seen = set()
-        
+        # 去重：dict 保持插入顺序，重复链接保留首次出现的节点（本地优先于订阅）
+        unique_by_link = {}
         for node in all_nodes:
-            node_id = node['original']
-            if node_id not in seen:
-                seen.add(node_id)
-                unique_nodes.append(node)
+            unique_by_link.setdefault(node['original'], node)
+        unique_nodes = list(unique_by_link.values())
+        
+        # 按服务器地址去重：同一服务器换个名字的配置只测试一次
+        if self.host_dedup:
+            endpoint_nodes = []
+            seen_endpoints = set()
+            
+            for node in unique_nodes:
+                host, port = self.extract_host_from_node(node)
+                if host is None:
+                    endpoint_nodes.append(node)
+                    continue
+                
+                endpoint = (node['type'], host, port)
+                if endpoint not in seen_endpoints:
+                    seen_endpoints.add(endpoint)
+                    endpoint_nodes.append(node)
+            
+            if len(endpoint_nodes) < len(unique_nodes):
+                print(f"🧹 按服务器去重: {len(unique_nodes)} → {len(endpoint_nodes)} 个")
+            unique_nodes = endpoint_nodes
         
         # 如果指定了测试数量，进行抽样
         if self.test_count > 0 and len(unique_nodes) > self.test_count:
@@ -171,6 +381,7 @@ class NodeSelector:
                     
                     node = self.parse_node_line(line)
                     if node:
+                        node['source'] = 'local'
                         nodes.append(node)
                     else:
                         print(f"⚠️ 第{line_num}行无法解析: {line[:50]}...")
@@ -185,73 +396,109 @@ class NodeSelector:
         """解析单行节点配置"""
         line = line.strip()
         
-        patterns = [
-            {'regex': r'^ssr://([A-Za-z0-9+/=]+)', 'type': 'ssr'},
-            {'regex': r'^vmess://([A-Za-z0-9+/=]+)', 'type': 'vmess'},
-            {'regex': r'^trojan://([^@]+)@([^:]+):(\d+)', 'type': 'trojan'},
-            {'regex': r'^vless://([^@]+)@([^:]+):(\d+)', 'type': 'vless'},
-            {'regex': r'^ss://([A-Za-z0-9+/=]+)', 'type': 'ss'}
-        ]
+        scheme, sep, body = line.partition('://')
+        pattern = _NODE_PATTERNS.get(scheme) if sep else None
+        if pattern is None:
+            return None
+        
+        match = pattern.match(body)
+        if not match:
+            return None
         
-        for pattern in patterns:
-            match = re.match(pattern['regex'], line)
-            if match:
-                return {
-                    'original': line,
-                    'type': pattern['type'],
-                    'parts': match.groups()
-                }
+        return {
+            'original': line,
+            'type': scheme,
+            'parts': match.groups()
+        }
+    
+    def extract_host_from_node(self, node):
+        """提取节点服务器地址和端口，无法解析时返回 (None, None)"""
+        node_type = node['type']
         
-        return None
+        try:
+            if node_type in ('trojan', 'vless'):
+                return node['parts'][1], int(node['parts'][2])
+            
+            body = node['original'].partition('://')[2].split('#', 1)[0]
+            
+            # SIP002格式: ss://base64(method:password)@host:port
+            if node_type == 'ss' and '@' in body:
+                parsed = urlparse(node['original'])
+                return parsed.hostname, parsed.port
+            
+            return _decode_endpoint(node_type, body.split('?', 1)[0])
+            
+        except Exception:
+            return None, None
     
-    def test_latency(self, node):
-        """测试节点延迟"""
+    def _tcp_reachable(self, host, port, timeout=1.0):
+        """TCP连接探测，用于在完整测试前快速排除不可达节点"""
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                return True
+        except OSError:
+            return False
+    
+    def _probe_latency(self, test_url):
+        """探测单个测试地址的延迟"""
+        session = self._session()
+        
+        try:
+            # HEAD请求不下载响应体，只测往返延迟；服务器不支持时退回GET
+            start_time = time.perf_counter()
+            response = session.head(test_url['url'], timeout=(_CONNECT_TIMEOUT, 8), allow_redirects=False)
+            
+            if response.status_code == 405:
+                # 只等到响应头（首字节）为止，不下载响应体
+                start_time = time.perf_counter()
+                response = session.get(test_url['url'], timeout=(_CONNECT_TIMEOUT, 8), stream=True)
+            
+            latency = int((time.perf_counter() - start_time) * 1000)
+            response.close()
+            
+            return {
+                'url': test_url['name'],
+                'latency': latency,
+                'status': response.status_code,
+                'success': response.status_code == test_url['expected_status'],
+                'weight': test_url['weight']
+            }
+            
+        except requests.RequestException as e:
+            return {
+                'url': test_url['name'],
+                'latency': -1,
+                'status': 0,
+                'success': False,
+                'error': str(e),
+                'weight': test_url['weight']
+            }
+    
+    def test_latency(self, node, probe_executor):
+        """测试节点延迟（所有测试地址在 probe_executor 中并发探测）"""
         test_results = []
         fastest_success = None
         
-        for test_url in self.test_urls:
-            try:
-                start_time = time.time()
-                
-                response = requests.get(
-                    test_url['url'],
-                    timeout=8,
-                    headers={
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                    }
-                )
-                
-                latency = int((time.time() - start_time) * 1000)
-                is_success = response.status_code == test_url['expected_status']
-                
-                test_result = {
-                    'url': test_url['name'],
-                    'latency': latency,
-                    'status': response.status_code,
-                    'success': is_success,
-                    'weight': test_url['weight']
-                }
-                
-                test_results.append(test_result)
-                
-                if is_success and latency < self.latency_threshold:
-                    if not fastest_success or latency < fastest_success['latency']:
-                        fastest_success = test_result
-                
-                if latency < 100:
-                    break
-                    
-                time.sleep(0.3)
-                
-            except requests.RequestException as e:
-                test_results.append({
-                    'url': test_url['name'],
-                    'latency': -1,
-                    'status': 0,
-                    'success': False,
-                    'error': str(e),
-                    'weight': test_url['weight']
-                })
+        futures = [
+            probe_executor.submit(self._probe_latency, test_url)
+            for test_url in self.test_urls
+        ]
+        
+        for future in concurrent.futures.as_completed(futures):
+            test_result = future.result()
+            test_results.append(test_result)
+            
+            latency = test_result['latency']
+            if test_result['success'] and latency < self.latency_threshold:
+                if not fastest_success or latency < fastest_success['latency']:
+                    fastest_success = test_result
+            
+            # 已经拿到足够快的结果，不再等待其余探测
+            if fastest_success and fastest_success['latency'] < 100:
+                break
+        
+        for future in futures:
+            future.cancel()
         
         return {
             'fastest_success': fastest_success,
@@ -259,19 +506,14 @@ class NodeSelector:
             'passed': fastest_success is not None
         }
     
-    def test_download_speed(self, node, latency):
-        """测试下载速度"""
-        if latency >= 1000:
-            return 0
-            
+    def test_download_speed(self, latency):
+        """测试下载速度（只对延迟低于 _SPEED_TEST_MAX_LATENCY 的节点调用）"""
         print(f"    🚀 开始速度测试，当前延迟: {latency}ms")
         
         if latency < 200:
             file_size = 512000
-        elif latency < 500:
-            file_size = 256000
         else:
-            file_size = 102400
+            file_size = 256000
         
         speed_test_urls = [
             f'https://httpbin.org/bytes/{file_size}',
@@ -280,25 +522,22 @@ class NodeSelector:
         
         for test_url in speed_test_urls:
             try:
-                start_time = time.time()
-                
-                response = requests.get(
-                    test_url,
-                    timeout=10,
-                    stream=True,
-                    headers={
-                        'User-Agent': 'Mozilla/5.0',
-                        'Cache-Control': 'no-cache'
-                    }
-                )
-                response.raise_for_status()
-                
-                content = b''
-                for chunk in response.iter_content(chunk_size=8192):
-                    content += chunk
-                
-                duration = time.time() - start_time
-                data_size = len(content)
+                # with 保证出错时也关闭流式响应，连接不会滞留在连接池外
+                with self._session().get(test_url, timeout=(_CONNECT_TIMEOUT, 10), stream=True) as response:
+                    response.raise_for_status()
+                    
+                    # 收到响应头后才开始计时：建连、TLS握手和首字节等待不计入传输速度
+                    start_time = time.perf_counter()
+                    
+                    # 只需要字节数，不保留下载内容
+                    data_size = 0
+                    for chunk in response.iter_content(chunk_size=65536):
+                        data_size += len(chunk)
+                        # 已持续下载足够时间和数据量，速度估计已稳定，不必下完整个文件
+                        if data_size >= 65536 and time.perf_counter() - start_time >= 0.5:
+                            break
+                    
+                    duration = time.perf_counter() - start_time
                 
                 if data_size > 0 and duration > 0:
                     speed_kbps = (data_size / duration) / 1024
@@ -308,8 +547,6 @@ class NodeSelector:
                     
             except requests.RequestException:
                 continue
-                
-            time.sleep(0.5)
         
         print("    ⚠️ 测速失败")
         return 0
@@ -318,13 +555,13 @@ class NodeSelector:
         """获取地理位置信息"""
         try:
             if not ip:
-                ip_response = requests.get('https://httpbin.org/ip', timeout=5)
+                ip_response = self.session.get('https://httpbin.org/ip', timeout=(_CONNECT_TIMEOUT, 5))
                 if ip_response.status_code == 200:
                     ip_data = ip_response.json()
                     ip = ip_data.get('origin', '').split(',')[0]
             
             if ip:
-                geo_response = requests.get(f'http://ip-api.com/json/{ip}', timeout=5)
+                geo_response = self.session.get(f'http://ip-api.com/json/{ip}', timeout=(_CONNECT_TIMEOUT, 5))
                 if geo_response.status_code == 200:
                     geo_data = geo_response.json()
                     if geo_data.get('status') == 'success':
@@ -349,46 +586,26 @@ class NodeSelector:
         if latency <= 0:
             return 0
         
-        if latency < 50:
-            latency_score = 100
-        elif latency < 100:
-            latency_score = 95
-        elif latency < 200:
-            latency_score = 85
-        elif latency < 300:
-            latency_score = 75
-        elif latency < 500:
-            latency_score = 60
-        else:
-            latency_score = 40
-        
-        if speed == 0:
-            speed_score = 0
-        elif speed > 5000:
-            speed_score = 100
-        elif speed > 2000:
-            speed_score = 90
-        elif speed > 1000:
-            speed_score = 80
-        elif speed > 500:
-            speed_score = 70
-        elif speed > 100:
-            speed_score = 50
-        else:
-            speed_score = 30
+        latency_score = _LATENCY_SCORES[bisect.bisect_right(_LATENCY_BOUNDS, latency)]
+        speed_score = _SPEED_SCORES[bisect.bisect_left(_SPEED_BOUNDS, speed)]
         
         success_score = 100 if success else 0
         
         total_score = (latency_score * 0.6 + speed_score * 0.4 + success_score * 0.2) / 1.2
         return round(total_score, 1)
     
-    def test_single_node(self, node, index, total_count):
+    def test_single_node(self, node, index, total_count, probe_executor):
         """测试单个节点"""
         node_id = f"{index+1}/{total_count}"
         print(f"\n🔍 测试节点 {node_id}: {node['type']}节点")
         
         try:
-            latency_test = self.test_latency(node)
+            host, port = self.extract_host_from_node(node)
+            if host and port and not self._tcp_reachable(host, port):
+                print(f"    ❌ 节点端口不可达: {host}:{port}")
+                return None
+            
+            latency_test = self.test_latency(node, probe_executor)
             
             if not latency_test['passed']:
                 print(f"    ❌ 未通过延迟测试")
@@ -397,11 +614,10 @@ class NodeSelector:
             latency = latency_test['fastest_success']['latency']
             print(f"    ✅ 延迟测试通过: {latency}ms")
             
+            # 测速在所有节点测完延迟后统一进行（见 run_tests），这里先按速度0评分
             speed = 0
-            if latency < self.latency_threshold:
-                speed = self.test_download_speed(node, latency)
             
-            geo_info = self.get_geo_info()
+            geo_info = self.geo_info
             
             score = self.calculate_score(latency, speed, latency_test['fastest_success']['success'])
             
@@ -417,13 +633,22 @@ class NodeSelector:
                 'source': node.get('source', 'unknown')
             }
             
-            print(f"    📊 综合评分: {score}")
             return result
             
         except Exception as e:
             print(f"    ❌ 测试失败: {e}")
             return None
     
+    def test_result_speed(self, result):
+        """为已通过延迟测试的节点测速并更新评分"""
+        try:
+            result['speed'] = self.test_download_speed(result['latency'])
+            result['score'] = self.calculate_score(result['latency'], result['speed'], result['success'])
+        except Exception as e:
+            # 测速失败不影响已有的延迟结果，按速度0保留
+            print(f"    ❌ 测速失败: {e}")
+        return result
+    
     def run_tests(self):
         """运行所有测试"""
         print("🚀 开始节点测试...")
@@ -435,27 +660,66 @@ class NodeSelector:
         
         print(f"📊 总共 {len(nodes)} 个节点需要测试\n")
         
-        passed_count = 0
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_node = {
-                executor.submit(self.test_single_node, node, i, len(nodes)): (i, node)
-                for i, node in enumerate(nodes)
-            }
+        try:
+            self.geo_info = self.get_geo_info()
             
-            for future in concurrent.futures.as_completed(future_to_node):
-                i, node = future_to_node[future]
-                try:
-                    result = future.result()
-                    if result:
-                        with self.lock:
-                            self.results.append(result)
-                            if result['success']:
-                                passed_count += 1
-                except Exception as e:
-                    print(f"❌ 节点测试异常: {e}")
-        
-        self.results.sort(key=lambda x: x['score'], reverse=True)
+            passed_count = 0
+            
+            # 每个节点的多个测试地址并发探测，单独的线程池避免与节点任务互相占用
+            probe_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers * len(self.test_urls)
+            )
+            
+            with self._cached_dns(), \
+                 probe_executor, \
+                 concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # 滑动窗口提交：在途任务不超过 max_workers*2 个，节点再多内存占用也固定
+                pending_nodes = enumerate(nodes)
+                window = self.max_workers * 2
+                inflight = set()
+                
+                while True:
+                    for i, node in itertools.islice(pending_nodes, window - len(inflight)):
+                        inflight.add(executor.submit(
+                            self.test_single_node, node, i, len(nodes), probe_executor
+                        ))
+                    
+                    if not inflight:
+                        break
+                    
+                    done, inflight = concurrent.futures.wait(
+                        inflight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    
+                    for future in done:
+                        try:
+                            result = future.result()
+                            # 结果只在主线程中收集，无需加锁
+                            if result:
+                                self.results.append(result)
+                                if result['success']:
+                                    passed_count += 1
+                        except Exception as e:
+                            print(f"❌ 节点测试异常: {e}")
+                
+                # 测速是最耗时的一步，只对延迟最低的一批节点进行，其余节点不会进入订阅
+                speed_limit = min(_SPEED_TEST_MAX_LATENCY, self.latency_threshold // 2)
+                candidates = sorted(
+                    (r for r in self.results if r['success'] and r['latency'] < speed_limit),
+                    key=operator.itemgetter('latency')
+                )[:self.top_n * 2]
+                
+                if candidates:
+                    print(f"\n🚀 对延迟最低的 {len(candidates)} 个节点进行测速...")
+                    for i, result in enumerate(executor.map(self.test_result_speed, candidates), 1):
+                        print(f"    📊 {i}/{len(candidates)} {result['type']}节点: "
+                              f"{result['latency']}ms, {result['speed']}KB/s, 综合评分 {result['score']}")
+        finally:
+            # 测试线程已全部退出，释放各会话持有的连接
+            for session in self._sessions:
+                session.close()
+        
+        self.results.sort(key=operator.itemgetter('score'), reverse=True)
         
         print(f'\n🎉 测试完成! 通过节点: {passed_count}/{len(nodes)}')
         return True
@@ -464,6 +728,9 @@ class NodeSelector:
         """生成NekoBox/FlClash可用的订阅文件"""
         print("\n📡 生成订阅文件...")
         
+        # 生成时间，所有输出文件共用
+        generated_at = datetime.now()
+        
         valid_nodes = []
         for result in self.results:
             if (result['success'] and 
@@ -479,75 +746,100 @@ class NodeSelector:
         
         print(f"🎯 选取了 {len(valid_nodes)} 个优质节点")
         
-        subscription_content = self._create_subscription_content(valid_nodes)
+        subscription_content = self._create_subscription_content(valid_nodes, generated_at)
         
-        encoded_content = base64.b64encode(subscription_content.encode()).decode()
+        raw_bytes = subscription_content.encode('utf-8')
+        encoded_content = base64.b64encode(raw_bytes).decode('ascii')
         
-        os.makedirs(self.output_dir, exist_ok=True)
+        self.output_path.mkdir(parents=True, exist_ok=True)
         
-        sub_file = os.path.join(self.output_dir, 'subscription.txt')
-        with open(sub_file, 'w', encoding='utf-8') as f:
-            f.write(encoded_content)
+        sub_file = self.output_path / 'subscription.txt'
+        sub_file.write_text(encoded_content, encoding='utf-8')
         
-        decoded_file = os.path.join(self.output_dir, 'subscription_decoded.txt')
-        with open(decoded_file, 'w', encoding='utf-8') as f:
-            f.write(subscription_content)
+        (self.output_path / 'subscription_decoded.txt').write_text(subscription_content, encoding='utf-8')
         
-        json_file = os.path.join(self.output_dir, 'subscription_info.json')
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                'timestamp': datetime.now().isoformat(),
-                'node_count': len(valid_nodes),
-                'nodes': valid_nodes,
-                'subscription_base64': encoded_content
-            }, f, indent=2, ensure_ascii=False)
+        json_file = self.output_path / 'subscription_info.json'
+        self._write_json(json_file, {
+            'timestamp': generated_at.isoformat(),
+            'node_count': len(valid_nodes),
+            'nodes': valid_nodes
+        })
         
         # 生成使用指南（不使用f-string包含复杂表达式）
-        self._generate_usage_guide(valid_nodes, sub_file)
+        self._generate_usage_guide(valid_nodes, sub_file, generated_at)
         
         return encoded_content
     
-    def _create_subscription_content(self, nodes):
+    def _write_json(self, path, data):
+        """写入紧凑格式的JSON文件（安装了orjson时使用orjson加速）"""
+        if orjson is not None:
+            with open(path, 'wb') as f:
+                f.write(orjson.dumps(data))
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    
+    def _summarize_nodes(self, nodes):
+        """一次遍历计算节点统计信息"""
+        latency_sum = speed_sum = score_sum = 0
+        min_latency = None
+        
+        for node in nodes:
+            latency = node['latency']
+            latency_sum += latency
+            if min_latency is None or latency < min_latency:
+                min_latency = latency
+            speed_sum += node.get('speed', 0)
+            score_sum += node['score']
+        
+        count = len(nodes)
+        return {
+            'avg_latency': latency_sum / count,
+            'min_latency': min_latency,
+            'avg_speed': speed_sum / count / 1024,
+            'avg_score': score_sum / count
+        }
+    
+    def _create_subscription_content(self, nodes, generated_at):
         """创建订阅内容"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = generated_at.strftime('%Y-%m-%d %H:%M:%S')
+        stats = self._summarize_nodes(nodes)
         
         content_lines = [
             "# 🚀 NekoBox/FlClash 优选订阅",
             f"# 生成时间: {timestamp}",
             f"# 节点数量: {len(nodes)}",
-            f"# 平均延迟: {sum(n['latency'] for n in nodes)/len(nodes):.0f}ms",
-            f"# 平均速度: {sum(n.get('speed', 0) for n in nodes)/len(nodes)/1024:.1f} MB/s",
-            f"# 平均评分: {sum(n['score'] for n in nodes)/len(nodes):.1f}",
+            f"# 平均延迟: {stats['avg_latency']:.0f}ms",
+            f"# 平均速度: {stats['avg_speed']:.1f} MB/s",
+            f"# 平均评分: {stats['avg_score']:.1f}",
             ""
         ]
         
-        for i, node in enumerate(nodes, 1):
-            speed_mbps = node.get('speed', 0) / 1024
-            content_lines.append(f"# {i}. {node['country']} | {node['latency']}ms | {speed_mbps:.1f}MB/s | {node['score']}分")
-            content_lines.append(node['node'])
-            content_lines.append("")
+        # 每个节点一段：注释行 + 节点链接 + 空行
+        content_lines.extend(
+            _SUBSCRIPTION_NODE_TEMPLATE.format(index=i, speed_mb=node.get('speed', 0) / 1024, **node)
+            for i, node in enumerate(nodes, 1)
+        )
         
         return '\n'.join(content_lines)
     
-    def _generate_usage_guide(self, nodes, sub_file_path):
+    def _generate_usage_guide(self, nodes, sub_file_path, generated_at):
         """生成使用指南"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        avg_latency = sum(n['latency'] for n in nodes) / len(nodes)
-        avg_speed = sum(n.get('speed', 0) for n in nodes) / len(nodes) / 1024
-        avg_score = sum(n['score'] for n in nodes) / len(nodes)
+        timestamp = generated_at.strftime('%Y-%m-%d %H:%M:%S')
+        stats = self._summarize_nodes(nodes)
         
         # 避免在f-string中使用反斜杠
         file_path_abs = os.path.abspath(sub_file_path)
         file_path_url = "file://" + file_path_abs.replace('\\', '/')
         
-        guide = f"""# 🎯 NekoBox/FlClash 订阅使用指南
+        header = f"""# 🎯 NekoBox/FlClash 订阅使用指南
 
 ## 📊 订阅信息
 - 生成时间: {timestamp}
 - 节点数量: {len(nodes)} 个
-- 最佳延迟: {min(n['latency'] for n in nodes)}ms
-- 平均速度: {avg_speed:.1f} MB/s
-- 平均评分: {avg_score:.1f}
+- 最佳延迟: {stats['min_latency']}ms
+- 平均速度: {stats['avg_speed']:.1f} MB/s
+- 平均评分: {stats['avg_score']:.1f}
 
 ## 📱 使用方法
 
@@ -583,19 +875,15 @@ class NodeSelector:
 ## 📋 节点详情
 """
         
-        for i, node in enumerate(nodes, 1):
-            speed_mbps = node.get('speed', 0) / 1024
-            guide += f"{i}. {node['country']} - {node['latency']}ms - {speed_mbps:.1f}MB/s - {node['score']}分 ({node['type']})\n"
-        
-        guide += "\n## ⚙️ 客户端配置建议\n"
-        guide += "1. NekoBox: 添加订阅 → 粘贴链接 → 自动更新\n"
-        guide += "2. FlClash: 订阅管理 → 添加 → 粘贴链接\n"
-        guide += "3. 建议开启自动选择最快节点\n"
-        guide += "4. 更新频率: 每6-12小时自动更新\n"
+        node_lines = [
+            _USAGE_NODE_TEMPLATE.format(index=i, speed_mb=node.get('speed', 0) / 1024, **node)
+            for i, node in enumerate(nodes, 1)
+        ]
         
-        guide_file = os.path.join(self.output_dir, 'USAGE.md')
+        # 分段直接写入文件，避免字符串反复 += 拷贝
+        guide_file = self.output_path / 'USAGE.md'
         with open(guide_file, 'w', encoding='utf-8') as f:
-            f.write(guide)
+            f.writelines([header, *node_lines, _USAGE_GUIDE_FOOTER])
         
         # 生成部署脚本
         self._generate_deploy_scripts(nodes)
@@ -605,52 +893,17 @@ class NodeSelector:
     def _generate_deploy_scripts(self, nodes):
         """生成部署脚本"""
         
-        nodes_list = '\n'.join([n['node'] for n in nodes])
+        nodes_list = '\n'.join(n['node'] for n in nodes)
         encoded_nodes = base64.b64encode(nodes_list.encode()).decode()
         
-        cf_worker_script = f"""// Cloudflare Worker 部署订阅
-addEventListener('fetch', event => {{
-  event.respondWith(handleRequest(event.request))
-}})
-
-const nodes = `{encoded_nodes}`
-
-async function handleRequest(request) {{
-  const url = new URL(request.url)
-  
-  if (url.pathname === '/subscribe') {{
-    return new Response(nodes, {{
-      headers: {{
-        'Content-Type': 'text/plain;charset=UTF-8',
-        'Cache-Control': 'public, max-age=3600',
-        'Access-Control-Allow-Origin': '*'
-      }}
-    }})
-  }}
-  
-  return new Response('NekoBox Subscription Service', {{ status: 200 }})
-}}
-"""
-        
-        vercel_function = f"""// Vercel Function (api/subscribe.js)
-module.exports = (req, res) => {{
-  const nodes = `{encoded_nodes}`
-  
-  res.setHeader('Content-Type', 'text/plain;charset=UTF-8')
-  res.setHeader('Cache-Control', 'public, max-age=3600')
-  res.setHeader('Access-Control-Allow-Origin', '*')
-  res.send(nodes)
-}}
-"""
-        
-        scripts_dir = os.path.join(self.output_dir, 'deploy_scripts')
-        os.makedirs(scripts_dir, exist_ok=True)
+        cf_worker_script = _CF_WORKER_TEMPLATE.format(encoded_nodes=encoded_nodes)
+        vercel_function = _VERCEL_FUNCTION_TEMPLATE.format(encoded_nodes=encoded_nodes)
         
-        with open(os.path.join(scripts_dir, 'cloudflare_worker.js'), 'w', encoding='utf-8') as f:
-            f.write(cf_worker_script)
+        scripts_dir = self.output_path / 'deploy_scripts'
+        scripts_dir.mkdir(parents=True, exist_ok=True)
         
-        with open(os.path.join(scripts_dir, 'vercel_function.js'), 'w', encoding='utf-8') as f:
-            f.write(vercel_function)
+        (scripts_dir / 'cloudflare_worker.js').write_text(cf_worker_script, encoding='utf-8')
+        (scripts_dir / 'vercel_function.js').write_text(vercel_function, encoding='utf-8')
         
         print(f"⚙️ 部署脚本已生成到: {scripts_dir}")
 
@@ -666,8 +919,8 @@ def main():
     parser.add_argument('--subscription', '-s', 
                        help='在线订阅地址，多个用&分隔')
     
-    parser.add_argument('--workers', '-w', type=int, default=3,
-                       help='并发工作线程数 (默认: 3)')
+    parser.add_argument('--workers', '-w', type=int, default=32,
+                       help='并发工作线程数 (默认: 32)')
     parser.add_argument('--timeout', '-t', type=int, default=10,
                        help='请求超时时间(秒) (默认: 10)')
     parser.add_argument('--latency-threshold', '-l', type=int, default=2000,
@@ -676,6 +929,8 @@ def main():
                        help='测试节点数量，0表示测试所有 (默认: 0)')
     parser.add_argument('--top-n', type=int, default=15,
                        help='选取最佳节点的数量 (默认: 15)')
+    parser.add_argument('--no-host-dedup', action='store_true',
+                       help='不按服务器地址去重，同一服务器的不同配置分别测试')
     
     parser.add_argument('--nodes-file', '-i', default='Nodes',
                        help='输入节点文件路径 (默认: Nodes)')